@@ -1,22 +1,37 @@
-import os, json
-from dotenv import load_dotenv
+import os, io, base64, hashlib, asyncio, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
 
 import streamlit as st
-import pandas as pd
-import openai
+import orjson
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import streamlit.components.v1 as components
 
+# pandas, openai, httpx and diskcache are imported where used:
+# Streamlit re-executes this script on every interaction, and none of them
+# is needed to draw the input form.
+if TYPE_CHECKING:
+    import pandas as pd
+    from openai import AsyncOpenAI
+
 # ──────────────────────────  ENV & PAGE  ──────────────────────────────────
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+if "OPENAI_API_KEY" not in os.environ:
+    from dotenv import load_dotenv
+    load_dotenv()
 
 st.set_page_config(page_title="Brand Semantic Triple Generator", layout="wide")
 st.title("Brand Semantic Triple Generator")
 st.markdown("**Subject | Predicate | Object | Category**")
 
 # ──────────────────────────  SESSION DEFAULTS  ────────────────────────────
-st.session_state.setdefault("synonyms", {})
-st.session_state.setdefault("last_df", pd.DataFrame())
+# Plain `in` checks, not setdefault(): its default is built on every rerun.
+if "synonyms" not in st.session_state:
+    st.session_state["synonyms"] = {}
+if "last_df" not in st.session_state:
+    st.session_state["last_df"] = None
+if "batch_id" not in st.session_state:
+    st.session_state["batch_id"] = None
 
 # ──────────────────────────  USER INPUTS  ─────────────────────────────────
 brand = st.text_input("Brand (used as Subject in every triple)")
@@ -31,22 +46,274 @@ num_triples = st.slider("Number of triples to generate", 10, 200, 50, 10)
 include_category = st.checkbox("Include “category” column", value=True)
 
 # ──────────────────────────  OpenAI Helper  ───────────────────────────────
-def gpt_json(prompt: str):
-    """Call GPT-4o in JSON-only mode."""
-    resp = openai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.4,
-        response_format={"type": "json_object"},
+def http_options():
+    """httpx settings shared by the sync and async clients: HTTP/2 with a keep-alive pool."""
+    import httpx
+    return {
+        "http2": True,
+        "limits": httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        # Fan-out replies are not streamed and can run to thousands of tokens.
+        "timeout": httpx.Timeout(60.0, read=300.0),
+    }
+
+@st.cache_resource
+def openai_client():
+    """One client per process, so its connection pool is reused across calls and reruns."""
+    import httpx
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=httpx.Client(**http_options()),
+        max_retries=0,   # llm_retry owns retries
+    )
+
+@st.cache_resource
+def llm_cache():
+    """On-disk response cache (L2); survives restarts."""
+    from diskcache import Cache
+    return Cache(".llm_cache")
+
+MEMORY_CACHE_SIZE = 256
+
+@st.cache_resource
+def memory_cache():
+    """In-process LRU (L1) of reply bytes in front of llm_cache, plus its lock."""
+    return OrderedDict(), threading.Lock()
+
+def cached_reply(key: str):
+    """Reply bytes from L1, else L2 (promoted to L1); None on a miss."""
+    lru, lock = memory_cache()
+    with lock:
+        if key in lru:
+            lru.move_to_end(key)
+            return lru[key]
+    hit = llm_cache().get(key)
+    if hit is not None:
+        remember_reply(key, hit, disk=False)
+    return hit
+
+def remember_reply(key: str, reply: bytes, disk: bool = True):
+    lru, lock = memory_cache()
+    with lock:
+        lru[key] = reply
+        lru.move_to_end(key)
+        while len(lru) > MEMORY_CACHE_SIZE:
+            lru.popitem(last=False)
+    if disk:
+        llm_cache().set(key, reply, expire=7 * 86400)
+
+TRIPLE_SCHEMA = {
+    "name": "triples",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "triples": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "subject": {"type": "string"},
+                        "predicate": {"type": "string"},
+                        "object": {"type": "string"},
+                        "category": {"type": "string"},
+                    },
+                    "required": ["subject", "predicate", "object", "category"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["triples"],
+        "additionalProperties": False,
+    },
+}
+
+def chat_request(
+    prompt: str,
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.4,
+    max_tokens: int | None = None,
+    schema: dict | None = None,
+):
+    """
+    Chat-completion body, shared by live and batch calls.
+    JSON-only mode, or structured output when a json_schema is given.
+    """
+    body = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": temperature,
+        "response_format": (
+            {"type": "json_schema", "json_schema": schema} if schema
+            else {"type": "json_object"}
+        ),
+    }
+    if max_tokens:
+        body["max_tokens"] = max_tokens
+    return body
+
+def is_transient(exc: BaseException):
+    """Same set the SDK retries by default: connection errors, timeouts, 408/409/429 and 5xx."""
+    from openai import APIConnectionError, APIStatusError
+    if isinstance(exc, APIConnectionError):   # includes APITimeoutError
+        return True
+    return isinstance(exc, APIStatusError) and (
+        exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    )
+
+# Up to 4 attempts with jittered exponential backoff, so concurrent calls that
+# hit a rate limit together don't retry in lockstep. Works on async defs too.
+llm_retry = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(is_transient),
+    reraise=True,
+)
+
+class TruncatedReply(ValueError):
+    """The reply stopped at max_tokens, so its JSON is incomplete."""
+
+@contextmanager
+def openai_errors():
+    """Show a failed OpenAI call (after retries) as st.error instead of a traceback."""
+    from openai import OpenAIError
+    try:
+        yield
+    except OpenAIError as e:
+        st.error(f"OpenAI request failed: {e}")
+    except (TruncatedReply, orjson.JSONDecodeError) as e:
+        st.error(f"OpenAI reply could not be parsed: {e}")
+
+def check_finished(finish_reason: str | None):
+    """Raise a readable error for a reply cut off at max_tokens (its JSON is incomplete)."""
+    if finish_reason == "length":
+        raise TruncatedReply("the reply hit the token limit; try generating fewer triples.")
+
+def cache_key(body: dict):
+    return hashlib.blake2b(orjson.dumps(body), digest_size=16).hexdigest()
+
+@llm_retry
+def stream_json_text(body: dict, box):
+    """Stream one completion into `box`, return the full text. Retried as a whole."""
+    text, finish_reason = "", None
+    stream = openai_client().chat.completions.create(**body, stream=True)
+    for i, chunk in enumerate(stream):
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        if chunk.choices[0].delta.content:
+            text += chunk.choices[0].delta.content
+            if i % 20 == 0:   # throttle redraws of the growing buffer
+                box.code(text, language="json")
+    check_finished(finish_reason)
+    return text
+
+def gpt_json(
+    prompt: str,
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.4,
+    max_tokens: int | None = None,
+    schema: dict | None = None,
+):
+    """
+    Call GPT-4o in JSON-only mode. Cached per request (prompt, model and
+    every tunable), in memory and on disk for a week.
+    On a miss the reply is streamed into a placeholder so progress shows while
+    it arrives. Not st.cache_data: that would record and replay every frame.
+    """
+    body = chat_request(prompt, model, temperature, max_tokens, schema)
+    key = cache_key(body)
+    hit = cached_reply(key)
+    if hit is not None:
+        return orjson.loads(hit)
+
+    box = st.empty()
+    try:
+        text = stream_json_text(body, box)
+    finally:
+        box.empty()   # never leave a partial reply on the page
+    raw = orjson.loads(text)   # parse before caching so bad JSON is never stored
+    remember_reply(key, text.encode())
+    return raw
+
+@llm_retry
+async def gpt_json_async(client: "AsyncOpenAI", body: dict):
+    """Non-streaming twin of gpt_json for fan-out."""
+    key = cache_key(body)
+    hit = cached_reply(key)
+    if hit is not None:
+        return orjson.loads(hit)
+
+    resp = await client.chat.completions.create(**body)
+    check_finished(resp.choices[0].finish_reason)
+    text = resp.choices[0].message.content
+    raw = orjson.loads(text)
+    remember_reply(key, text.encode())
+    return raw
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def gpt_json_fanout(bodies: tuple):
+    """
+    Send every request body concurrently; return the parsed replies in order.
+    The requests are multiplexed over one HTTP/2 connection. The async client
+    lives for a single asyncio.run, because its connections are bound to that loop.
+    """
+    import httpx
+    from openai import AsyncOpenAI
+
+    async def run():
+        async with AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=httpx.AsyncClient(**http_options()),
+            max_retries=0,   # llm_retry owns retries
+        ) as client:
+            return await asyncio.gather(*(gpt_json_async(client, b) for b in bodies))
+    return asyncio.run(run())
+
+# ──────────────────────────  BATCH API  ───────────────────────────────────
+def submit_batch(prompt: str, max_tokens: int | None = None, schema: dict | None = None):
+    """Upload a one-line JSONL job to the Batch API (half price, 24h window); return its id."""
+    line = {
+        "custom_id": "triples",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": chat_request(prompt, max_tokens=max_tokens, schema=schema),
+    }
+    batch_file = openai_client().files.create(
+        file=("triples.jsonl", orjson.dumps(line) + b"\n"),
+        purpose="batch",
     )
-    return json.loads(resp.choices[0].message.content)
+    batch = openai_client().batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+def batch_json(output_file_id: str):
+    """Download a finished batch and return the parsed JSON of its single response."""
+    line = openai_client().files.content(output_file_id).text.splitlines()[0]
+    body = orjson.loads(line)["response"]["body"]
+    check_finished(body["choices"][0].get("finish_reason"))
+    return orjson.loads(body["choices"][0]["message"]["content"])
 
 # ──────────────────────────  PARSE TRIPLES  ───────────────────────────────
+COLS = ("subject", "predicate", "object", "category")
+
 def normalize_triples(raw):
     """
     Accept list, 'triples' dict, numbered dict, or any dict with a single list.
     Return DataFrame with ordered columns; drop category if user unchecked box.
     """
+    import pandas as pd
+
+    cols = list(COLS if include_category else COLS[:3])
+
+    # Fast path: the TRIPLE_SCHEMA shape, i.e. {"triples": [{...}, ...]}
+    if isinstance(raw, dict) and isinstance(raw.get("triples"), list) \
+            and all(isinstance(t, dict) for t in raw["triples"]):
+        return pd.DataFrame(raw["triples"], columns=cols).fillna("")
+
     if isinstance(raw, list):
         triples = raw
     elif isinstance(raw, dict):
@@ -59,27 +326,25 @@ def normalize_triples(raw):
     else:
         triples = []
 
-    df = pd.DataFrame(triples)
-    for col in ("subject", "predicate", "object", "category"):
-        if col not in df:
-            df[col] = ""
-    if not include_category and "category" in df:
-        df = df.drop(columns="category")
-    return df
+    # Gather column-wise in one pass so pandas builds each column in one go.
+    data = {k: [] for k in cols}
+    for t in triples:
+        if not isinstance(t, dict):
+            continue
+        for k, v in data.items():
+            v.append(t.get(k, ""))
+    return pd.DataFrame(data)
+
+def store_triples(df: "pd.DataFrame"):
+    """Keep the frame plus its CSV bytes, so reruns reuse the CSV instead of rebuilding it."""
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False)
+    st.session_state["last_df"] = df
+    st.session_state["last_csv"] = buf.getvalue()
 
 # ──────────────────────────  SYNONYM FETCHER  ─────────────────────────────
-def fetch_synonyms(text: str, label: str):
+def parse_synonyms(raw):
     """Return synonym list; handles nested and numbered JSON structures."""
-    if not text.strip():
-        return []
-
-    prompt = (
-        f"For the following {label} terms, suggest 5–10 closely related words or phrases. "
-        "Return ONLY a JSON object whose single key is `synonyms`, mapped to an array of strings.\n\n"
-        + text
-    )
-    raw = gpt_json(prompt)
-
     # 1. Expected shape
     if isinstance(raw, dict) and isinstance(raw.get("synonyms"), list):
         return [w.strip() for w in raw["synonyms"] if isinstance(w, str)]
@@ -106,6 +371,31 @@ def fetch_synonyms(text: str, label: str):
 
     return []
 
+SYNONYM_FIELDS = {
+    # session label        JSON key            prompt label
+    "Services / Products": ("services",        "Services / products"),
+    "Audience":            ("audience",        "Audience"),
+    "Value Propositions":  ("values",          "Value propositions"),
+    "Differentiators":     ("differentiators", "Differentiators"),
+}
+
+def fetch_synonyms(fields: tuple):
+    """
+    One request for every non-empty field: tuple of (session label, text) pairs.
+    Return {session label: synonym list}.
+    """
+    keys = [SYNONYM_FIELDS[label][0] for label, _ in fields]
+    prompt = (
+        f"Return a JSON object with keys {', '.join(keys)}. "
+        "Each value is a list of 5–10 closely related words or phrases "
+        "for the corresponding input terms below.\n\n"
+        + "\n".join(f"{SYNONYM_FIELDS[label][1]}: {text}" for label, text in fields)
+    )
+    raw = gpt_json(prompt, max_tokens=400)
+    if not isinstance(raw, dict):
+        return {}
+    return {label: parse_synonyms(raw.get(key)) for (label, _), key in zip(fields, keys)}
+
 # ──────────────────────────  BADGE STYLING  ───────────────────────────────
 COLOR_MAP = {
     "services / products": "#1f77b4",
@@ -115,17 +405,32 @@ COLOR_MAP = {
     "differentiators": "#9467bd",
 }
 
-def badge(df: pd.DataFrame):
-    if "category" not in df:
-        return df
-    def style(v):
-        color = COLOR_MAP.get(str(v).lower(), "#999")
-        return f"background-color:{color};color:white"
-    return df.style.apply(
-        lambda col: [style(v) if col.name == "category" else "" for v in col],
-        axis=0,
+def html_escape(col: "pd.Series"):
+    """Vectorized html.escape for a column of LLM text."""
+    return (
+        col.astype(str)
+        .str.replace("&", "&amp;", regex=False)
+        .str.replace("<", "&lt;", regex=False)
+        .str.replace(">", "&gt;", regex=False)
+        .str.replace('"', "&quot;", regex=False)
     )
 
+def badge(df: "pd.DataFrame"):
+    """
+    Render triples as a single HTML table string, category cells as colour badges.
+    Built with vectorized string ops: no Styler, no per-row Python callback.
+    """
+    rows = "<tr>"
+    for col in df.columns:
+        if col == "category":
+            colors = df[col].astype(str).str.lower().map(COLOR_MAP).fillna("#999")
+            rows = rows + '<td style="background:' + colors + ';color:white">'
+        else:
+            rows = rows + "<td>"
+        rows = rows + html_escape(df[col]) + "</td>"
+    head = "".join(f"<th>{col}</th>" for col in df.columns)
+    return f"<table><tr>{head}</tr>{''.join(rows + '</tr>')}</table>"
+
 # ──────────────────────────  PREVIEW BUTTON  ──────────────────────────────
 if st.button("🔎 Preview – one per category"):
     if not brand:
@@ -134,66 +439,132 @@ if st.button("🔎 Preview – one per category"):
         prompt = (
             f'Subject is "{brand}". Generate ONE triple each for services / products, '
             "audience, value-propositions, differentiators. "
-            "Return JSON array with subject, predicate, object, category.\n\n"
+            "Return a JSON object whose `triples` array holds subject, predicate, object, category.\n\n"
             f"Services / products: {services}\nAudience: {audience}\n"
             f"Value propositions: {values}\nDifferentiators: {diffs}"
         )
-        df_prev = normalize_triples(gpt_json(prompt))
-        st.session_state["last_df"] = df_prev
-        st.subheader("Preview")
-        st.write(badge(df_prev))
+        with openai_errors():
+            df_prev = normalize_triples(gpt_json(prompt, max_tokens=400, schema=TRIPLE_SCHEMA))
+            store_triples(df_prev)
+            st.subheader("Preview")
+            st.markdown(badge(df_prev), unsafe_allow_html=True)
 
 # ──────────────────────────  GENERATE FULL SET  ───────────────────────────
-if st.button(f"⚙️ Generate {num_triples} triples"):
+CATEGORIES = ("services / products", "audience", "value-propositions", "differentiators")
+FANOUT_CHUNK = 50   # larger sets are split into concurrent requests of at most this many
+
+def triples_prompt(count: int, category: str | None = None):
+    scope = (
+        f'all with category "{category}"' if category
+        else "evenly across " + ", ".join(CATEGORIES)
+    )
+    return (
+        f'Subject is "{brand}". Produce EXACTLY {count} triples, {scope}. '
+        "Return a JSON object whose `triples` array holds subject, predicate, object, category.\n\n"
+        f"Services / products: {services}\nAudience: {audience}\n"
+        f"Value propositions: {values}\nDifferentiators: {diffs}"
+    )
+
+def triple_tokens(count: int):
+    return min(16000, 80 * count + 200)   # ~80 tokens per triple + envelope
+
+def generate_triples(count: int):
+    """
+    Up to FANOUT_CHUNK triples come from one streamed request. Larger sets are
+    split evenly by category into concurrent requests and concatenated.
+    """
+    import pandas as pd
+
+    if count <= FANOUT_CHUNK:
+        return normalize_triples(gpt_json(
+            triples_prompt(count), max_tokens=triple_tokens(count), schema=TRIPLE_SCHEMA
+        ))
+    per_cat = [count // len(CATEGORIES) + (i < count % len(CATEGORIES))
+               for i in range(len(CATEGORIES))]
+    bodies = tuple(
+        chat_request(triples_prompt(part, cat), max_tokens=triple_tokens(part), schema=TRIPLE_SCHEMA)
+        for cat, n in zip(CATEGORIES, per_cat)
+        for part in [FANOUT_CHUNK] * (n // FANOUT_CHUNK) + [n % FANOUT_CHUNK]
+        if part
+    )
+    return pd.concat([normalize_triples(r) for r in gpt_json_fanout(bodies)], ignore_index=True)
+
+g1, g2 = st.columns([1, 3])
+generate = g1.button(f"⚙️ Generate {num_triples} triples")
+as_batch = g2.checkbox("Submit as batch job (50% cheaper, results within 24h)")
+
+if generate:
     if not brand:
         st.warning("Enter a brand first.")
+    elif as_batch:
+        with openai_errors():
+            st.session_state["batch_id"] = submit_batch(
+                triples_prompt(num_triples), triple_tokens(num_triples), TRIPLE_SCHEMA
+            )
+            st.info(f"Batch {st.session_state['batch_id']} submitted. Check back for results.")
     else:
-        prompt = (
-            f'Subject is "{brand}". Produce EXACTLY {num_triples} triples, '
-            "evenly across services / products, audience, value-propositions, differentiators. "
-            "Return JSON array with subject, predicate, object, category.\n\n"
-            f"Services / products: {services}\nAudience: {audience}\n"
-            f"Value propositions: {values}\nDifferentiators: {diffs}"
-        )
-        df = normalize_triples(gpt_json(prompt))
-        st.session_state["last_df"] = df
-        st.success(f"{len(df)} triples ready.")
-        st.write(badge(df))
+        with openai_errors():
+            df = generate_triples(num_triples)
+            store_triples(df)
+            st.success(f"{len(df)} triples ready.")
+            st.markdown(badge(df), unsafe_allow_html=True)
+
+if st.session_state["batch_id"] and st.button("🔄 Check batch status"):
+    with openai_errors():
+        batch = openai_client().batches.retrieve(st.session_state["batch_id"])
+        if batch.status == "completed" and batch.output_file_id:
+            df = normalize_triples(batch_json(batch.output_file_id))
+            store_triples(df)
+            st.session_state["batch_id"] = None
+            st.success(f"{len(df)} triples ready.")
+            st.markdown(badge(df), unsafe_allow_html=True)
+        elif batch.status in ("completed", "failed", "expired", "cancelled"):
+            st.error(f"Batch {batch.id} ended as {batch.status} without results.")
+            st.session_state["batch_id"] = None
+        else:
+            st.info(f"Batch {batch.id} is {batch.status}.")
 
 # ──────────────────────────  CLIPBOARD & CSV  ─────────────────────────────
-if not st.session_state["last_df"].empty:
-    csv_text = st.session_state["last_df"].to_csv(index=False)
+df_last = st.session_state.get("last_df")
+if df_last is not None and not df_last.empty:
+    csv_bytes = st.session_state["last_csv"]
+    b64 = base64.b64encode(csv_bytes).decode()   # no HTML escaping of CSV needed
     components.html(
         f"""
-        <textarea id="clip" style="opacity:0">{csv_text}</textarea>
-        <button onclick="navigator.clipboard.writeText(document.getElementById('clip').value)"
+        <button onclick="navigator.clipboard.writeText(new TextDecoder().decode(
+                    Uint8Array.from(atob('{b64}'), c => c.charCodeAt(0))))"
                 style="padding:6px 12px;margin:4px 0;">📋 Copy to clipboard</button>
         """,
         height=45,
     )
     st.download_button(
         "💾 Download CSV",
-        data=csv_text.encode(),
+        data=csv_bytes,
         file_name=f"{brand.lower().replace(' ','_')}_semantic_triples.csv",
         mime="text/csv",
     )
 
 # ──────────────────────────  SYNONYMS BUTTON  ─────────────────────────────
 if st.button("💡 Suggest similar words"):
-    st.session_state["synonyms"] = {
-        "Services / Products": fetch_synonyms(services, "service or product"),
-        "Audience": fetch_synonyms(audience, "audience"),
-        "Value Propositions": fetch_synonyms(values, "value proposition"),
-        "Differentiators": fetch_synonyms(diffs, "differentiator"),
-    }
-
-if st.session_state["synonyms"]:
-    syn_df = (
-        pd.DataFrame(st.session_state["synonyms"].items(), columns=["category", "synonyms"])
+    texts = dict(zip(SYNONYM_FIELDS, (services, audience, values, diffs)))
+    todo = tuple((k, v) for k, v in texts.items() if v.strip())   # skip empty inputs
+    synonyms = {k: [] for k in SYNONYM_FIELDS}
+    if todo:
+        with openai_errors():
+            synonyms.update(fetch_synonyms(todo))
+    st.session_state["synonyms"] = synonyms
+
+def synonyms_frame(synonyms: dict):
+    import pandas as pd
+
+    return (
+        pd.DataFrame(synonyms.items(), columns=["category", "synonyms"])
         .assign(synonyms=lambda d: d.synonyms.apply(", ".join))
     )
+
+if st.session_state["synonyms"]:
     st.subheader("🔄 Suggested Similar Words")
-    st.table(syn_df)
+    st.table(synonyms_frame(st.session_state["synonyms"]))
 
 # ──────────────────────────  FOOTER  ──────────────────────────────────────
 st.markdown(